@@ -6,41 +6,107 @@ WebSocket Connection to get log data from the server
 To authenticate we use a cookie with the name "x-servertap-key"
 """
 
+import atexit
+import collections
+import functools
 import json
 import re
 import time
-from typing import Callable, Dict, List, Tuple
+from typing import Callable, Dict, List, Set, Tuple
 import os
-import datetime
 # Import SocketIO
 import requests
 import websocket
 
 import server
 
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
 
-KNOWN_COMMANDS = []
+KNOWN_COMMANDS: Set[str] = set()
 
-if not os.path.exists(".messages"):
-    with open(".messages", "w") as f:
-        f.write("[]")
+# Matches command help lines like "/<command>: ..."
+_CMD_RE = re.compile(r"^/([^\s]+):")
+
+# Migrate the old JSON array file to one message per line
+if os.path.exists(".messages") and not os.path.exists(".messages.jsonl"):
+    with open(".messages", "r") as f, open(".messages.jsonl", "w") as out:
+        for old_message in json.load(f):
+            out.write(old_message + "\n")
+
+# If the file does not exist, create it
+if not os.path.exists(".messages.jsonl"):
+    with open(".messages.jsonl", "w") as f:
+        f.write("")
+
+# Hashes of the most recent messages for constant time deduplication
+# (least recently seen are evicted once the cap is reached)
+KNOWN_MESSAGE_HASHES_MAXLEN = 100_000
+KNOWN_MESSAGE_HASHES: "collections.OrderedDict[int, None]" = collections.OrderedDict()
+
+# Stream the stored messages, only their hashes are kept in memory
+with open(".messages.jsonl", "r") as f:
+    for line in f:
+        line = line.rstrip("\n")
+        
+        if not line.strip():
+            continue
+        
+        KNOWN_MESSAGE_HASHES[hash(line)] = None
+        
+        if len(KNOWN_MESSAGE_HASHES) > KNOWN_MESSAGE_HASHES_MAXLEN:
+            KNOWN_MESSAGE_HASHES.popitem(last=False)
+
+# Buffered append-only writer for new messages, flushed periodically
+_msg_fp = open(".messages.jsonl", "a", buffering=1 << 16)
+_msg_lock = Lock()
+
+MESSAGES_FLUSH_INTERVAL = 0.2
+
+def flush_messages():
+    """
+    Flush the buffered message file
+    """
+    
+    with _msg_lock:
+        _msg_fp.flush()
+
+def _flush_messages_periodically():
+    """
+    Periodically flush the buffered message file
+    """
+    
+    while True:
+        time.sleep(MESSAGES_FLUSH_INTERVAL)
+        flush_messages()
+
+Thread(target=_flush_messages_periodically, daemon=True).start()
+atexit.register(flush_messages)
 
-with open(".messages", "r") as f:
-    KNOWN_MESSAGES: List[Dict] = json.load(f)
- 
 # If the file does not exist, create it
 if not os.path.exists("commands.txt"):
     with open("commands.txt", "w") as f:
         f.write("")
 
 with open("commands.txt", "r") as f:
-    KNOWN_COMMANDS = f.read().split("\n")
+    commands_content = f.read()
+    KNOWN_COMMANDS = {command for command in commands_content.split("\n") if command}
 
+# Append-only writer for newly discovered commands
+_cmd_fp = open("commands.txt", "a")
+
+# Older files were written without a trailing newline
+if commands_content and not commands_content.endswith("\n"):
+    _cmd_fp.write("\n")
+    _cmd_fp.flush()
+
+del commands_content
+
+@functools.lru_cache(maxsize=1)
 def get_token() -> str:
     """
     Try to get token from either environment variable or from the file
-    .sec
+    .sec (cached, see reload_token)
     """
     
     # Try to get the token from the environment variable
@@ -57,6 +123,13 @@ def get_token() -> str:
     except FileNotFoundError:
         pass
     
+def reload_token():
+    """
+    Drop the cached token so it is read again on next use
+    """
+    
+    get_token.cache_clear()
+    
 def get_host() -> str:
     """
     Try to get the host from the environment variable
@@ -88,104 +161,149 @@ class MinecraftSocket:
     
     latest_message: int = 0
     
-    callbacks: List['server.SSHServer']
+    # Incremented whenever a new command is discovered
+    known_commands_version: int = 0
+    
+    # Subscribers and their single-worker executors, so a client that
+    # stops reading only stalls its own (ordered) deliveries
+    callbacks: Dict['server.SSHServer', ThreadPoolExecutor]
     
-    _players: List[str]
-    players_last_updated: int = 0
+    _players: List[Dict]
+    _player_names: List[str]
+    players_last_updated: float = 0
+    _players_last_attempt: float = 0
+    
+    # Sorted view of KNOWN_COMMANDS, rebuilt when the version changes
+    _known_commands_sorted: List[str] = []
+    _known_commands_sorted_version: int = -1
     
     @property
     def known_commands(self) -> List[str]:
-        return KNOWN_COMMANDS
+        if self._known_commands_sorted_version != self.known_commands_version:
+            self._known_commands_sorted_version = self.known_commands_version
+            self._known_commands_sorted = sorted(KNOWN_COMMANDS)
+        
+        return self._known_commands_sorted
     
     def __init__(self):
         self.host = get_host()
         self.port = get_port()
-        self.callbacks = []
+        self.callbacks = {}
+        self._cb_lock = Lock()
+        
+        # Set once the WebSocket connection is open
+        self._open_event = Event()
+        
+        # Cached players, the session keeps the connection alive between polls
+        self._players = []
+        self._player_names = []
+        self._session = requests.Session()
         
     def get_online_players(self) -> List[str]:
         """
         Get the online players
         """
         
-        if time.time() - self.players_last_updated < 10:
+        # Don't retry more often than the cache expires, even on errors
+        if time.time() - self._players_last_attempt < 10:
             return self._players
         
-        self.players_last_updated = time.time()
+        self._players_last_attempt = time.time()
         
         url = f"http://{self.host}:4567/v1/players"
         
         try:
-            response = requests.get(url, headers={"key": get_token()})
+            response = self._session.get(url, headers={"key": get_token()}, timeout=2)
             response.raise_for_status()
         except requests.exceptions.RequestException as e:
             server.log(f"Error getting online players: {e}")
-            return []
+            return self._players
         
         self._players = response.json()
+        self._player_names = [player["displayName"] for player in self._players]
+        self.players_last_updated = time.time()
         
-        return response.json()
+        return self._players
     
     @property
     def players(self) -> List[str]:
-        return [player["displayName"] for player in self.get_online_players()]
+        # Refresh the cache if it expired
+        self.get_online_players()
+        
+        return self._player_names
             
     def format_message(self, message: Dict) -> str:
-        time = message["timestampMillis"]
-        time_formatted = datetime.datetime.fromtimestamp(time / 1000).strftime('%Y-%m-%d %H:%M:%S')
+        tm = time.localtime(message["timestampMillis"] // 1000)
+        time_formatted = f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d} {tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}"
         
         return f"{time_formatted} {message['level']} : {message['message']}"
     
     def subscribe(self, callbackServer: 'server.SSHServer'):
         server.log(f"[WebSocket] Subscribed by {callbackServer}")
         
-        self.callbacks.append(callbackServer)
+        with self._cb_lock:
+            self.callbacks[callbackServer] = ThreadPoolExecutor(max_workers=1)
         
-        server.log(f"[WebSocket] Callbacks: {self.callbacks}")
+        server.log(f"[WebSocket] Callbacks: {list(self.callbacks)}")
         
     def unsubscribe(self, callbackServer: 'server.SSHServer'):
         server.log(f"[WebSocket] Unsubscribed by {callbackServer}")
         
-        self.callbacks.remove(callbackServer)
+        self._remove_callback(callbackServer)
+        
+        server.log(f"[WebSocket] Callbacks: {list(self.callbacks)}")
+    
+    def _remove_callback(self, callbackServer: 'server.SSHServer'):
+        """
+        Remove a subscriber and drop its pending deliveries
+        """
+        
+        with self._cb_lock:
+            executor = self.callbacks.pop(callbackServer, None)
         
-        server.log(f"[WebSocket] Callbacks: {self.callbacks}")
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
         
     def on_open(self, ws):
         server.log("[WebSocket] Opened new connection")
         
-    def on_message(self, ws, message, *args, **kwargs):
-        global KNOWN_MESSAGES
+        self._open_event.set()
         
+    def on_message(self, ws, message, *args, **kwargs):
         json_message = json.loads(message)
         
         # If the message is older than the latest message, ignore it
         if json_message["timestampMillis"] < self.latest_message:
             return
         
-        if message in KNOWN_MESSAGES:
+        message_hash = hash(message)
+        
+        if message_hash in KNOWN_MESSAGE_HASHES:
+            KNOWN_MESSAGE_HASHES.move_to_end(message_hash)
             return
         
-        KNOWN_MESSAGES.append(message)
+        KNOWN_MESSAGE_HASHES[message_hash] = None
+        
+        if len(KNOWN_MESSAGE_HASHES) > KNOWN_MESSAGE_HASHES_MAXLEN:
+            KNOWN_MESSAGE_HASHES.popitem(last=False)
         
         self.latest_message = json_message["timestampMillis"]
         
-        with open(".messages", "w") as f:
-            json.dump(KNOWN_MESSAGES, f, indent=4)
+        with _msg_lock:
+            _msg_fp.write(message + "\n")
         
         server.log(f"[WebSocket] Received message: {message}")
         
         # If the message starts with /<...>, then it is a command
         # Add to KNOWN_COMMANDS and dont emit
-        global KNOWN_COMMANDS
-        
-        regex = r"^\/([^\s]+):"
-        
-        if (match := re.match(regex, json_message["message"])):
+        if (match := _CMD_RE.match(json_message["message"])):
             command = match.group(1)
             
             if command not in KNOWN_COMMANDS:
-                KNOWN_COMMANDS.append(command)
-                with open("commands.txt", "w") as f:
-                    f.write("\n".join(KNOWN_COMMANDS))
+                KNOWN_COMMANDS.add(command)
+                self.known_commands_version += 1
+                _cmd_fp.write(command + "\n")
+                _cmd_fp.flush()
             
         try:
             formatted = self.format_message(json_message)
@@ -193,8 +311,12 @@ class MinecraftSocket:
             server.log(f"[WebSocket] Error formatting message: {e}")
             return
         
-        for callback in self.callbacks:
-            def wrapper():
+        # Iterate over a snapshot, callbacks may be removed concurrently
+        with self._cb_lock:
+            callbacks = tuple(self.callbacks.items())
+        
+        for callback, executor in callbacks:
+            def wrapper(callback=callback):
                 try:
                     with callback.lock:
                         callback.mc_callback(ws, formatted)
@@ -202,9 +324,13 @@ class MinecraftSocket:
                     server.log(f"[WebSocket] Error in callback: {e}")
                 
                     # Remove the callback
-                    self.callbacks.remove(callback)
-                
-            Thread(target=wrapper).start()
+                    self._remove_callback(callback)
+            
+            try:
+                executor.submit(wrapper)
+            except RuntimeError:
+                # Unsubscribed in the meantime
+                pass
             
     def send(self, message: str):
         try:
@@ -238,6 +364,8 @@ class MinecraftSocket:
         }
         
         # Create the WebSocket
+        self._open_event.clear()
+        
         server.log(f"[WebSocket] Connecting to {url}", end=": ")
         self.ws = websocket.WebSocketApp(url, on_message=self.on_message, on_open=self.on_open, header=headers, on_close=self.on_close, on_error=self.on_error)
         
@@ -246,11 +374,8 @@ class MinecraftSocket:
         wsThread.start()
         
         # Wait for the WebSocket to open
-        i = 0
-        while not self.ws.sock or not self.ws.sock.connected:
-            if i % 10 == 0:
-                server.log(".")
-            i += 1
-            time.sleep(0.1)
+        if not self._open_event.wait(timeout=30):
+            server.log("[WebSocket] Timed out waiting for connection")
+            return
             
         server.log("[WebSocket] Connected")
\ No newline at end of file
@@ -4,11 +4,16 @@ Paramiko Server for SSH (Minecraft console via SSH)
 """
 
 # Import the required libraries
+import atexit
+import codecs
 import datetime
 import os
+import queue
+import re
+import signal
 import threading
 import time
-from typing import Any, Generator, List
+from typing import Any, List, Set, TextIO
 import paramiko
 import socket
 from sshpubkeys import SSHKey
@@ -23,6 +28,29 @@ logging.basicConfig(level=logging.INFO)
 
 THREADS: List[threading.Thread] = []
 
+# A single character or a complete escape sequence sent by the client
+INPUT_TOKEN_RE = re.compile(r"\x1b[^ABCDEFGHJKSTfmnsulh~]*[ABCDEFGHJKSTfmnsulh~]|[^\x1b]", re.DOTALL)
+
+# Pre-encoded ANSI escape sequences
+CLEAR_LINE = b"\x1b[2K"
+CLEAR_SCREEN = b"\x1b[2J"
+RESET = b"\x1b[0m"
+BROADCAST_CYAN = b"\x1b[1;36m"
+BUILTIN_BLUE = b"\x1b[1;34m"
+CMD_GREEN = b"\x1b[1;32m"
+CMD_RED = b"\x1b[1;31m"
+COMPLETION_GRAY = b"\x1b[30m"
+
+# Commands handled by the SSH server itself
+_BUILTIN_VERBS = frozenset({"exit", "clear", "reload", "cls", "reset"})
+
+# Log lines are queued and written by a single background thread
+LOG_QUEUE: "queue.Queue[str]" = queue.Queue()
+LOG_FLUSH_INTERVAL = 0.05
+
+_log_fp = open("server_log.txt", "a", buffering=65536)
+_log_lock = threading.Lock()
+
 def get_host() -> str:
     """
     Get the host from the environment variable
@@ -60,37 +88,124 @@ def log(data: str, end: str="\n"):
     
     string = f"[{timestamp}] {data}{end}"
     
-    with open("server_log.txt", "a") as f:
-        f.write(string)
+    LOG_QUEUE.put_nowait(string)
     
     print(string, end="")
 
+def _log_writer():
+    """
+    Write queued log lines to the file, flushing when the queue
+    drains or the flush interval has passed
+    """
+    
+    last_flush = time.time()
+    
+    while True:
+        string = LOG_QUEUE.get()
+        
+        try:
+            with _log_lock:
+                _log_fp.write(string)
+                
+                if LOG_QUEUE.empty() or time.time() - last_flush >= LOG_FLUSH_INTERVAL:
+                    _log_fp.flush()
+                    last_flush = time.time()
+        except OSError as e:
+            # Keep draining the queue, the line was already printed
+            print(f"[!] Error writing log file: {e}")
+        finally:
+            LOG_QUEUE.task_done()
+
+def flush_log():
+    """
+    Wait for all queued log lines to be written and flush the file
+    """
+    
+    LOG_QUEUE.join()
+    
+    with _log_lock:
+        _log_fp.flush()
+
+threading.Thread(target=_log_writer, daemon=True).start()
+atexit.register(flush_log)
+
+# Command history, one command per line (oldest first)
+HISTORY_FILE = "history.log"
+
+# Migrate the old history file (most recent first) to the new format
+if os.path.exists("history.txt") and not os.path.exists(HISTORY_FILE):
+    with open("history.txt", "r") as f, open(HISTORY_FILE, "w") as out:
+        for old_cmd in reversed(f.read().split("\n")):
+            if old_cmd:
+                out.write(old_cmd + "\n")
+
+# Fingerprints of the authorized keys, cached until a key file changes
+_authorized_fprints: Set[bytes] = set()
+_authorized_signature: tuple = None
+_authorized_lock = threading.Lock()
+
 # Read authorized keys from .authorized_keys
-def getAuthorizedKeys() -> Generator[paramiko.PKey, None, None]:
+def getAuthorizedKeys() -> Set[bytes]:
     """
-    Read all .pub files from the folder ./authorized_keys
+    Read all .pub files from the folder ./authorized_keys and return
+    their fingerprints (only re-read if a file was added, removed or
+    modified)
     """
     
+    global _authorized_fprints, _authorized_signature
+    
     # If the folder does not exist, create it
     if not os.path.exists("./authorized_keys"):
         os.mkdir("./authorized_keys")
     
-    # Get all the files in the folder
-    files = os.listdir("./authorized_keys")
+    # Name, mtime and size of every file, keys are rewritten in place
+    entries = []
     
-    log(f"[*] Reading {len(files)} public keys")
+    for entry in os.scandir("./authorized_keys"):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        
+        entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
     
-    # Read the public keys
-    for file in files:
-        with open(f"./authorized_keys/{file}", "r") as f:
-            key: SSHKey = SSHKey(f.read())
+    signature = tuple(sorted(entries))
+    
+    with _authorized_lock:
+        if signature == _authorized_signature:
+            return _authorized_fprints
+        
+        # Get all the files in the folder
+        files = [name for name, _, _ in signature]
+        
+        log(f"[*] Reading {len(files)} public keys")
+        
+        fprints: Set[bytes] = set()
+        
+        # Read the public keys
+        for file in files:
+            try:
+                with open(f"./authorized_keys/{file}", "r") as f:
+                    key: SSHKey = SSHKey(f.read())
+                    
+                    # Convert to paramiko key
+                    fprint = paramiko.RSAKey(key=key.rsa).get_fingerprint()
+            except Exception as e:
+                # Skip unreadable or non-RSA keys, the others still work
+                log(f"[!] Skipping public key {file}: {e}")
+                continue
             
-            # Convert to paramiko key
-            yield paramiko.RSAKey(key=key.rsa)
+            if len(fprint) > 0:
+                fprints.add(fprint)
+        
+        _authorized_fprints = fprints
+        _authorized_signature = signature
+        
+        return _authorized_fprints
     
 # Create a new class for the SSH server
 class SSHServer(paramiko.ServerInterface):
-    buffer: List[str] = None
+    buffer: str = ""
     history: List[str] = None
     position: int = 0
     selected: int = 0
@@ -98,10 +213,20 @@ class SSHServer(paramiko.ServerInterface):
     filter: str = ""
     
     input_thread: threading.Thread = None
+    channel: paramiko.Channel = None
     closing: bool = False
     
+    # Append-only handle for the command history (opened with the shell)
+    _hist_fp: TextIO = None
+    
     _lock: threading.Lock = None
     
+    # (key, value), assigned at once as redraws run on several threads
+    _formatted_cache: tuple = (None, b"")
+    
+    # (key, value), assigned at once as redraws run on several threads
+    _filter_cache: tuple = (None, None)
+    
     @property
     def lock(self):
         # Lock (for thread safety)
@@ -111,45 +236,10 @@ class SSHServer(paramiko.ServerInterface):
             
         return self._lock
     
-    @property
-    def player_suggestions(self) -> List[str]:
-        words = self.filter.split(" ")
-        
-        if len(self.filter) == 0 or len(words[0]) == 0:
-            return []
-        
-        if len(words) == 1 and self.is_command_complete:
-            return self.ws.players
-        
-        return [
-            self.buffer_str + player[len(words[-1]):]
-            for player in self.ws.players if player.startswith(words[-1])
-        ]
-    
-    @property
-    def selection(self) -> str:
-        if len(self.filtered_history) == 0:
-            return self.filter
-        
-        if self.selected >= len(self.filtered_history):
-            self.selected = 0
-        
-        return self.filtered_history[self.selected]
-    
-    @property
-    def suffix_selection(self) -> str:
-        if len(self.filtered_history[1:]) == 0:
-            return ""
-        
-        if self.selected_suffix >= len(self.filtered_history[1:]):
-            self.selected_suffix = 0
-        
-        return self.filtered_history[1:][self.selected_suffix]
-    
     # Paramiko implementation
     def __init__(self, ws: Any = None):
         self.ws = ws
-        self.buffer = []
+        self.buffer = ""
         self.history = [""]
         
         ws.subscribe(self)
@@ -164,17 +254,11 @@ class SSHServer(paramiko.ServerInterface):
     def check_auth_password(self, username, password):
         return paramiko.AUTH_FAILED
     
-    def check_auth_publickey(self, username, key):        
-        authorizedKeys = getAuthorizedKeys()
-        
-        # Check if SHA256 of the key is in the authorized keys
-        for authorizedKey in authorizedKeys:
-            if len(authorizedKey.get_fingerprint()) == 0:
-                continue
-            
-            if key.get_fingerprint() == authorizedKey.get_fingerprint():
-                log(f"[!] Accepted public key: ...{key.get_base64()[-8:]}")
-                return paramiko.AUTH_SUCCESSFUL
+    def check_auth_publickey(self, username, key):
+        # Check if the fingerprint of the key is in the authorized keys
+        if key.get_fingerprint() in getAuthorizedKeys():
+            log(f"[!] Accepted public key: ...{key.get_base64()[-8:]}")
+            return paramiko.AUTH_SUCCESSFUL
             
         return paramiko.AUTH_FAILED
     
@@ -205,77 +289,21 @@ class SSHServer(paramiko.ServerInterface):
         
         return True
     
-    def check_channel_exec_request(self, channel: paramiko.Channel, command: str) -> bool:
-        return True
-    
-    def get_server():
-        return "SSH-2.0-OpenSSH_7.6p1 Ubuntu-4ubuntu0.3"
-    
-    def add_history(self, cmd: str):
-        if len(self.history) == 1 or self.history[1] != cmd:
-            self.history.insert(0, cmd)
-            
-        # Save the history to a file
-        with open("history.txt", "w") as f:
-            f.write("\n".join(self.history[1:]))
-    
-    def load_history(self):
-        try:
-            with open("history.txt", "r") as f:
-                self.history = f.read().split("\n")
-        except FileNotFoundError:
-            pass
-    
-    def mc_callback(self, ws: Any, data: str):
+    @property
+    def prompt_origin(self) -> bytes:
         """
-        Callback function to send data to the SSH client
+        Move the cursor to the start of the prompt line and print "> "
         """
         
-        width = self.width
-        
-        while len(data) > 0:
-            pos: int = 0
-            chunk: str = data[:self.width]
-            
-            # Set cursor to the beginning of the line
-            self.send_to_client("\r")
-            
-            self.send_to_client(' ' * (self.width - width), True)
-            
-            # Send the chunk
-            self.send_to_client(chunk, True)
-            
-            # Remove the chunk from the data
-            data = data[self.width:]
-            
-            # Send a newline
-            self.send_to_client("\n", True)
-            
-            self.send_to_client("\r")
-            
-            width = self.width - 27
-            
-            if width < 0:
-                width = self.width
-        
-        # Restore the prompt
-        self.redraw_buffer()
-    
-    def redraw_buffer(self):
-        self.send_to_client("\r")
-        self.send_to_client("\033[J")
-        self.send_to_client(self.buffer_str)
+        return b"\x1b[%d;1H> " % self.height
     
-    def send_to_client(self, data: str, server: bool=False):
+    def _send_raw(self, chunks: List[bytes]):
         """
-        Send data to the SSH client
+        Send already encoded chunks to the SSH client in a single call
         """
         
-        # log(f"[*] Sending to client: {data.encode()}")
-        
         try:
-            # Send the data
-            self.channel.send(data.encode())
+            self.channel.send(b"".join(chunks))
         except OSError:
             pass
         
@@ -287,33 +315,28 @@ class SSHServer(paramiko.ServerInterface):
         log(f"[*] Sending to client: {data}")
         
         width = self.width
+        parts: List[bytes] = []
         
         while len(data) > 0:
             chunk: str = data[:self.width]
             
-            # Set cursor to the beginning of the line
-            self.send_to_client("\r")
-            
-            self.send_to_client(' ' * (self.width - width), True)
-            
-            # Send the chunk
-            self.send_to_client(chunk, True)
+            # Set cursor to the beginning of the line, indent and
+            # send the chunk followed by a newline
+            parts.append(b"\r")
+            parts.append((' ' * (self.width - width)).encode())
+            parts.append(chunk.encode())
+            parts.append(b"\n\r")
             
             # Remove the chunk from the data
             data = data[self.width:]
             
-            # Send a newline
-            self.send_to_client("\n", True)
-            
-            self.send_to_client("\r")
-            
             width = self.width - 27
             
             if width < 0:
                 width = self.width
         
-        # Restore the prompt
-        self.redraw_buffer()
+        # Send all lines and restore the prompt at once
+        self._send_raw(parts + self.prompt_chunks())
     
     def check_channel_exec_request(self, channel: paramiko.Channel, command: str) -> bool:
         return True
@@ -323,19 +346,25 @@ class SSHServer(paramiko.ServerInterface):
     
     # Own methods
     def add_history(self, cmd: str):
-        if len(self.history) == 1 or self.history[1] != cmd:
+        if len(self.history) == 1 or self.history[0] != cmd:
             self.history.insert(0, cmd)
             
-        # Save the history to a file
-        with open("history.txt", "w") as f:
-            f.write("\n".join(self.history[1:]))
+            # Append the command to the history file
+            self._hist_fp.write(cmd + "\n")
+            self._hist_fp.flush()
     
     def load_history(self):
+        if self._hist_fp is None:
+            self._hist_fp = open(HISTORY_FILE, "a", buffering=1 << 14)
+        
         try:
-            with open("history.txt", "r") as f:
-                self.history = f.read().split("\n")
+            with open(HISTORY_FILE, "r") as f:
+                content = f.read()
         except FileNotFoundError:
-            pass
+            return
+        
+        # The file is oldest first, the history most recent first
+        self.history = [cmd for cmd in reversed(content.split("\n")) if cmd] + [""]
     
     @property
     def player_suggestions(self) -> List[str]:
@@ -348,7 +377,7 @@ class SSHServer(paramiko.ServerInterface):
             return self.ws.players
         
         return [
-            self.buffer_str + player[len(words[-1]):]
+            self.buffer + player[len(words[-1]):]
             for player in self.ws.players if player.startswith(words[-1])
         ]
     
@@ -367,7 +396,7 @@ class SSHServer(paramiko.ServerInterface):
         if len(self.filtered_history[1:]) == 0:
             return ""
         
-        if self.selected_suffix >= len(self.filtered_history):
+        if self.selected_suffix >= len(self.filtered_history[1:]):
             self.selected_suffix = 0
         
         return self.filtered_history[1:][self.selected_suffix]
@@ -377,244 +406,295 @@ class SSHServer(paramiko.ServerInterface):
         if len(self.filter) == 0:
             return ""
         
-        return ''.join(list(self.suffix_selection)[len(self.filter):])
-    
-    @property
-    def buffer_str(self) -> str:
-        return "".join(self.buffer)
+        return self.suffix_selection[len(self.filter):]
     
     @property
     def is_command_complete(self) -> bool:
-        return self.buffer_str.strip().removeprefix('/') in self.ws.known_commands
+        return self.ws.is_valid_command(self.buffer.strip().removeprefix('/'))
     
     @property
-    def buffer_formatted(self):
+    def buffer_formatted(self) -> bytes:
         """
-        Format using ANSI
+        Format using ANSI (already encoded)
         """
         
         # If the buffer is empty, return
         if len(self.buffer) == 0:
-            return ""
+            return b""
+        
+        # Only recompute if the buffer or the known commands changed
+        buffer = self.buffer
+        cache_key = (buffer, self.ws.known_commands_version)
+        
+        cached_key, cached_val = self._formatted_cache
         
-        # Split the buffer into parts
-        parts = ''.join(self.buffer).split(" ")
+        if cache_key == cached_key:
+            return cached_val
+        
+        # Split the first word from the rest
+        first, sep, rest = buffer.partition(" ")
         
         # If the first word is a command, format it light blue and bold
-        if len(parts[0]) > 0 and parts[0][0].strip() == "!":
-            parts[0] = f"\x1b[1;36m{parts[0]}"
-            parts[-1] = f"{parts[-1]}\x1b[0m"
-        elif parts[0].strip() in ["exit", "clear", "reload", "cls", "reset"]:
-            parts[0] = f"\x1b[1;34m{parts[0]}\x1b[0m"
-        elif (
-                self.ws.is_valid_command(parts[0]) or 
-                (self.ws.is_valid_command(parts[0][1:]) and parts[0][0] == "!")
-            ):
-            parts[0] = f"\x1b[1;32m{parts[0]}\x1b[0m"
+        if len(first) > 0 and first[0].strip() == "!":
+            parts = [BROADCAST_CYAN, buffer.encode(), RESET]
         else:
-            parts[0] = f"\x1b[1;31m{parts[0]}\x1b[0m"
+            if first.strip() in _BUILTIN_VERBS:
+                color = BUILTIN_BLUE
+            elif (
+                    self.ws.is_valid_command(first) or 
+                    (self.ws.is_valid_command(first[1:]) and first[0] == "!")
+                ):
+                color = CMD_GREEN
+            else:
+                color = CMD_RED
+            
+            parts = [color, first.encode(), RESET, (sep + rest).encode()]
             
         # Join the parts
-        return " ".join(parts)
+        formatted = b"".join(parts)
+        self._formatted_cache = (cache_key, formatted)
+        
+        return formatted
     
     @property
     def filtered_history(self):
-        filtered = [cmd for cmd in (self.player_suggestions + self.history + self.ws.known_commands) if cmd.startswith(self.filter)]
+        # Only recompute if the filter or one of the sources changed
+        filter = self.filter
+        cache_key = (
+            filter,
+            self.buffer,
+            id(self.history),
+            len(self.history),
+            self.ws.known_commands_version,
+            self.ws.players_last_updated,
+        )
         
-        # Remove duplicates that are next to each other
-        return [self.filter] + [filtered[i] for i in range(len(filtered)) if i == 0 or filtered[i] != filtered[i-1]]
+        cached_key, cached_val = self._filter_cache
         
-    
-    def redraw_buffer(self):
-        # Clear the line
-        self.send_to_client("\x1b[2K")
+        if cache_key == cached_key:
+            return cached_val
         
-        # Print the buffer
-        self.send_to_client(f"\x1b[{self.height};1H> {self.buffer_formatted}")
+        filtered = [cmd for cmd in (self.player_suggestions + self.history + self.ws.known_commands) if cmd.startswith(filter)]
         
-        # Print completion
-        self.send_to_client(f"\x1b[{self.height};{len(self.buffer_str) + 3}H")
+        # Remove duplicates that are next to each other
+        history = [filter] + [filtered[i] for i in range(len(filtered)) if i == 0 or filtered[i] != filtered[i-1]]
+        self._filter_cache = (cache_key, history)
         
-        # Light gray completion
-        self.send_to_client(f"\x1b[30m{self.suffix}\x1b[0m")
+        return history
         
-        # Move the cursor to the right position
-        self.send_to_client(f"\x1b[{self.height};{self.position+3}H")
+    
+    def prompt_chunks(self) -> List[bytes]:
+        """
+        Encoded escape sequences to redraw the prompt
+        """
+        
+        return [
+            # Clear the line
+            CLEAR_LINE,
+            # Print the buffer
+            self.prompt_origin,
+            self.buffer_formatted,
+            # Print completion
+            b"\x1b[%d;%dH" % (self.height, len(self.buffer) + 3),
+            # Light gray completion
+            COMPLETION_GRAY,
+            self.suffix.encode(),
+            RESET,
+            # Move the cursor to the right position
+            b"\x1b[%d;%dH" % (self.height, self.position + 3),
+        ]
+    
+    def redraw_buffer(self):
+        self._send_raw(self.prompt_chunks())
         
     def accept_completion(self):
-        self.buffer = list(self.suffix_selection)
-        self.filter = self.buffer_str
+        self.buffer = self.suffix_selection
+        self.filter = self.buffer
         self.position = len(self.buffer)
         self.redraw_buffer()
         
     def close(self):
-        self.channel.close()
         self.closing = True
         
-        try:
-            self.input_thread.join()
-        except RuntimeError:
-            pass
+        # No channel is opened for e.g. failed authentications
+        if self.channel is not None:
+            self.channel.close()
+            
+            try:
+                self.input_thread.join()
+            except (RuntimeError, AttributeError):
+                pass
         
         self.ws.unsubscribe(self)
-    
-        log(f"[*] Closed connection to {self.channel.getpeername()}")
+        
+        if self._hist_fp is not None:
+            self._hist_fp.close()
+        
+        if self.channel is not None:
+            log(f"[*] Closed connection to {self.channel.getpeername()}")
         
     def send_command(self):
         if len(self.buffer) == 0:
             return
         
-        self.add_history("".join(self.buffer))
+        self.add_history(self.buffer)
         
-        if ''.join(self.buffer) == "reload":
-            self.buffer = list("reload confirm")
+        if self.buffer == "reload":
+            self.buffer = "reload confirm"
         
-        if ''.join(self.buffer) == "exit":
+        if self.buffer == "exit":
             self.close()
             exit(0)
-        elif ''.join(self.buffer) in ["clear", "cls"]:
-            self.send_to_client("\x1b[2J")
-            self.buffer = []
+        elif self.buffer in ["clear", "cls"]:
+            self._send_raw([CLEAR_SCREEN])
+            self.buffer = ""
             self.position = 0
             
             log(f"[*] Cleared log")
-        elif ''.join(self.buffer) == "reset":
+        elif self.buffer == "reset":
             # Restart this server
             # Popen sudo systemctl restart mcssh
             Popen(["sudo", "systemctl", "restart", "mcssh.service"])
             
             log(f"[*] Restarting server")            
-        elif "".join(self.buffer).strip()[0] == "!":
+        elif self.buffer.strip()[0] == "!":
             # Send broadcast
-            self.ws.send("/broadcast " + "".join(self.buffer[1:]))
+            self.ws.send("/broadcast " + self.buffer[1:])
             
-            log(f"[*] Sent broadcast: {''.join(self.buffer[1:])}")
+            log(f"[*] Sent broadcast: {self.buffer[1:]}")
         else:
-            self.ws.send("".join(self.buffer))
+            self.ws.send(self.buffer)
             
-            log(f"[*] Sent command: {''.join(self.buffer)}")
+            log(f"[*] Sent command: {self.buffer}")
         
-        self.buffer = []
+        self.buffer = ""
         self.position = 0
         self.selected = 0
         self.selected_suffix = 0
         
         # clear the line
-        self.send_to_client("\x1b[2K")
+        self._send_raw([CLEAR_LINE])
         
     def previous_command(self):
         if self.filter == "":
             self.selected = min(len(self.filtered_history) - 1, self.selected + 1)
-            self.buffer = list(self.filtered_history[self.selected])
+            self.buffer = self.filtered_history[self.selected]
             self.position = len(self.buffer)
         else:
             self.selected_suffix = min(len(self.filtered_history) - 1, self.selected_suffix + 1)
         
     def next_command(self):
         if self.selected == 0 and self.filter == "":
-            self.buffer = []
+            self.buffer = ""
             self.position = 0
             return
         
         if self.filter == "":
             self.selected = max(0, self.selected - 1)
             
-            self.buffer = list(self.filtered_history[self.selected])
+            self.buffer = self.filtered_history[self.selected]
             self.position = len(self.buffer)
         else:
             self.selected_suffix = max(0, self.selected_suffix - 1)
         
     def backspace(self):
-        if len(self.buffer) > 0:
-            self.buffer.pop(self.position - 1)
+        if self.position > 0:
+            self.buffer = self.buffer[:self.position - 1] + self.buffer[self.position:]
             self.position -= 1
     
     def update_filter(self):
-        self.filter = self.buffer_str
+        self.filter = self.buffer
+    
+    def read_input(self) -> List[str]:
+        """
+        Receive data from the client and split it into single keys and
+        escape sequences (incomplete sequences are kept for the next read)
+        """
+        
+        data = self.channel.recv(1024)
+        
+        if data == b"":
+            self.close()
+            exit(0)
+        
+        self._input_buf += self._decoder.decode(data)
+        
+        tokens: List[str] = []
+        pos = 0
+        
+        while (match := INPUT_TOKEN_RE.match(self._input_buf, pos)):
+            tokens.append(match.group())
+            pos = match.end()
+        
+        self._input_buf = self._input_buf[pos:]
+        
+        return tokens
     
     def input_handler(self):        
-        self.buffer = []
+        self._input_buf = ""
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.buffer = ""
         self.position = 0
         self.selected = 0
         
         self.load_history()
         
-        # Clear the screen
-        self.send_to_client("\x1b[2J")
-        
-        # Send initial prompt
-        self.send_to_client(f"\x1b[{self.height};1H> ")
+        # Clear the screen and send initial prompt
+        self._send_raw([CLEAR_SCREEN, self.prompt_origin])
         
         while not self.closing:
-            # Receive
-            while True:
-                data = self.channel.recv(1)
-                
-                if data == b"":
-                    self.close()
-                    exit(0)
-                
-                try:
-                    # Decode utf-8
-                    data.decode("utf-8")
-                    break
-                except UnicodeDecodeError:
-                    continue
-            
-            # If the data is an escape sequence, receive until the end
-            if data == b"\x1b":
-                while True:
-                    data += self.channel.recv(1)
-                    if data[-1] in b"ABCDEFGHJKSTfmnsulh~":
-                        break
-            
-            match data:
-                # Return
-                case b"\r":                    
-                    self.send_command()
-                    self.update_filter()
-                # Backspace
-                case b"\x7f":
-                    self.backspace()
-                    self.update_filter()
-                # Keyboad interrupt
-                case b"\x03":
-                    if len(self.buffer) > 0:
-                        self.buffer = []
-                        self.position = 0
-                    else:
-                        self.close()
-                        exit(0)
-                # Up arrow (history)
-                case b"\x1b[A":
-                    self.previous_command()
-                # Down arrow (history)
-                case b"\x1b[B":
-                    self.next_command()
-                # Left arrow
-                case b"\x1b[D":
-                    if self.position > 0:
-                        self.position -= 1
-                # Right arrow
-                case b"\x1b[C":
-                    if self.position == len(self.buffer):
+            # Receive and handle every key / escape sequence in the chunk
+            for data in self.read_input():
+                match data:
+                    # Return
+                    case "\r":                    
+                        self.send_command()
+                        self.update_filter()
+                    # Backspace
+                    case "\x7f":
+                        self.backspace()
+                        self.update_filter()
+                    # Keyboad interrupt
+                    case "\x03":
+                        if len(self.buffer) > 0:
+                            self.buffer = ""
+                            self.position = 0
+                        else:
+                            self.close()
+                            exit(0)
+                    # Up arrow (history)
+                    case "\x1b[A":
+                        self.previous_command()
+                    # Down arrow (history)
+                    case "\x1b[B":
+                        self.next_command()
+                    # Left arrow
+                    case "\x1b[D":
+                        if self.position > 0:
+                            self.position -= 1
+                    # Right arrow
+                    case "\x1b[C":
+                        if self.position == len(self.buffer):
+                            self.accept_completion()
+                            self.update_filter()
+                        elif self.position < len(self.buffer):
+                            self.position += 1
+                    # Tab
+                    case "\t":
                         self.accept_completion()
                         self.update_filter()
-                    elif self.position < len(self.buffer):
+                    # Delete
+                    case "\x1b[3~":
+                        if self.position < len(self.buffer):
+                            self.buffer = self.buffer[:self.position] + self.buffer[self.position + 1:]
+                        self.update_filter()
+                    # Other escape sequences (Home, End, F-keys, ...)
+                    case _ if data.startswith("\x1b"):
+                        pass
+                    case _:
+                        self.buffer = self.buffer[:self.position] + data + self.buffer[self.position:]
                         self.position += 1
-                # Tab
-                case b"\t":
-                    self.accept_completion()
-                    self.update_filter()
-                # Delete
-                case b"\x1b[3~":
-                    if self.position < len(self.buffer):
-                        self.buffer.pop(self.position)
-                    self.update_filter()
-                case _:
-                    self.buffer.insert(self.position, data.decode("utf-8"))
-                    self.position += 1
-                    self.update_filter()
+                        self.update_filter()
                     
             self.redraw_buffer()
         
@@ -633,6 +713,9 @@ def get_server_key():
 def main():
     key = get_server_key()
     
+    # Re-read the ServerTap token on SIGHUP
+    signal.signal(signal.SIGHUP, lambda signum, frame: mc.reload_token())
+    
     ws = mc.MinecraftSocket()
     
     ws.start()
@@ -686,6 +769,7 @@ def main():
             watchdog_thread.start()
         except KeyboardInterrupt:
             log("[!] Stopping server ...")
+            flush_log()
             
             for thread in THREADS:
                 thread.join()